@@ -1,9 +1,23 @@
-import tempfile
 import os
 import sys
+import struct
+import weakref
+from array import array
+from itertools import izip
 from cPickle import dump as pickle_dump, load as pickle_load
+from cPickle import dumps as pickle_dumps, loads as pickle_loads
 
-import pprocess
+# pprocess, tempfile and hashlib are imported on first use, so that
+# importing this module stays cheap for code that only needs
+# generator_map or generator_splitter
+_pprocess = None
+
+def _load_pprocess():
+    global _pprocess
+    if _pprocess is None:
+        import pprocess
+        _pprocess = pprocess
+    return _pprocess
 
 _log = None
 
@@ -11,6 +25,8 @@ class AsyncLog():
     def __init__(self):
         self.events = []
         self.time_base = os.times()[4]
+        self.cache_hits = 0
+        self.cache_misses = 0
     
     def enable(self, to_stderr=False):
         global _log
@@ -22,6 +38,8 @@ class AsyncLog():
         _log = None
         self.events = []
         self.time_base = os.times()[4]
+        self.cache_hits = 0
+        self.cache_misses = 0
     
     def add(self, msg):
         time = int((os.times()[4] - self.time_base) * 1000)
@@ -33,17 +51,299 @@ class AsyncLog():
 async_log = AsyncLog()
 
 
+def _record_batch_from_buffers(schema, buffers):
+    columns = []
+    for (name, typecode), buf in zip(schema, buffers):
+        column = array(typecode)
+        column.fromstring(buf)
+        columns.append(column)
+    return RecordBatch(schema, columns)
+
+class RecordBatch(object):
+    """
+    A batch of records with a fixed schema, stored as one `array` per
+    column. `schema` is a sequence of (name, typecode) pairs, using the
+    typecodes of the `array` module. Batches are written to tempfiles as
+    raw column buffers, and async jobs always pass them between processes
+    that way, because pprocess channels pickle at protocol 0, which turns
+    binary strings into escaped text. Pickling a batch directly gives one
+    string per column; that is only compact at protocol 2.
+    """
+    def __init__(self, schema, columns=None):
+        self.schema = tuple( (name, typecode) for name, typecode in schema )
+        self.names = [name for name, typecode in self.schema]
+        if columns is None:
+            columns = [array(typecode) for name, typecode in self.schema]
+        if len(columns) != len(self.schema):
+            raise ValueError('RecordBatch: expected %d columns, got %d' % (len(self.schema), len(columns)))
+        if len(set(len(c) for c in columns)) > 1:
+            raise ValueError('RecordBatch: all columns must have the same length')
+        self.columns = list(columns)
+    
+    @classmethod
+    def from_records(cls, schema, records):
+        batch = cls(schema)
+        for record in records:
+            batch.append(record)
+        return batch
+    
+    def append(self, record):
+        if isinstance(record, dict):
+            record = [record[name] for name in self.names]
+        if len(record) != len(self.columns):
+            raise ValueError('RecordBatch: expected %d fields, got %d' % (len(self.columns), len(record)))
+        # convert the whole row first, so a bad value leaves the batch as it was
+        values = [array(column.typecode, [value]) for column, value in zip(self.columns, record)]
+        for column, value in zip(self.columns, values):
+            column.extend(value)
+    
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(self.columns[0])
+    
+    def __getitem__(self, name):
+        try:
+            return self.columns[self.names.index(name)]
+        except ValueError:
+            raise KeyError(name)
+    
+    def row(self, i):
+        return tuple(column[i] for column in self.columns)
+    
+    def __iter__(self):
+        return izip(*self.columns)
+    
+    def records(self):
+        return [dict(zip(self.names, row)) for row in self]
+    
+    def __eq__(self, other):
+        return isinstance(other, RecordBatch) and \
+            self.schema == other.schema and self.columns == other.columns
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return '<RecordBatch %s, %d records>' % (', '.join(self.names), len(self))
+    
+    def __reduce__(self):
+        return (_record_batch_from_buffers,
+                (self.schema, [column.tostring() for column in self.columns]))
+
+# tempfiles holding a RecordBatch start with this marker, which can not be
+# the start of a pickle
+_RECORD_BATCH_MAGIC = '\0asyncgen-batch\n'
+
+def _dump_record_batch(batch, f):
+    header = pickle_dumps((batch.schema, len(batch)), 2)
+    f.write(_RECORD_BATCH_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for column in batch.columns:
+        column.tofile(f)
+
+def _load_record_batch(f):
+    size, = struct.unpack('<I', f.read(4))
+    schema, length = pickle_loads(f.read(size))
+    columns = []
+    for name, typecode in schema:
+        column = array(typecode)
+        column.fromfile(f, length)
+        columns.append(column)
+    return RecordBatch(schema, columns)
+
+# a record from a shared Splitter, with each key's value pickled on its own
+# and an index of offsets, so that a consumer can load just its own key
+_KEYED_RECORD_MAGIC = '\0asyncgen-record\n'
+
+def _dump_keyed_record(data, keys, f):
+    pieces = [pickle_dumps(data[key], 2) for key in keys]
+    index = {}
+    offset = 0
+    for key, piece in zip(keys, pieces):
+        index[key] = (offset, len(piece))
+        offset += len(piece)
+    header = pickle_dumps(index, 2)
+    f.write(_KEYED_RECORD_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for piece in pieces:
+        f.write(piece)
+
+def _has_magic(fileobj, magic):
+    fileobj.seek(0)
+    if fileobj.read(len(magic)) == magic:
+        return True
+    fileobj.seek(0)
+    return False
+
+def _load_record_key_and_remove_file(f, key):
+    """
+    load the value of `key` from a record file, reading only that key for
+    keyed records and record batches; plain pickles are loaded whole
+    """
+    fileobj = open(f, 'rb')
+    try:
+        if _has_magic(fileobj, _KEYED_RECORD_MAGIC):
+            size, = struct.unpack('<I', fileobj.read(4))
+            offset, length = pickle_loads(fileobj.read(size))[key]
+            fileobj.seek(offset, 1)
+            return pickle_loads(fileobj.read(length))
+        elif _has_magic(fileobj, _RECORD_BATCH_MAGIC):
+            size, = struct.unpack('<I', fileobj.read(4))
+            schema, length = pickle_loads(fileobj.read(size))
+            names = [name for name, typecode in schema]
+            if key not in names:
+                raise KeyError(key)
+            for name, typecode in schema:
+                data = array(typecode)
+                if name == key:
+                    data.fromfile(fileobj, length)
+                    return data
+                fileobj.seek(data.itemsize * length, 1)
+        else:
+            return pickle_load(fileobj)[key]
+    finally:
+        fileobj.close()
+        os.remove(f)
+
+def _unpickle_file(f):
+    fileobj = open(f, 'rb')
+    if fileobj.read(len(_RECORD_BATCH_MAGIC)) == _RECORD_BATCH_MAGIC:
+        data = _load_record_batch(fileobj)
+    else:
+        fileobj.seek(0)
+        data = pickle_load(fileobj)
+    fileobj.close()
+    return data
+
 def _unpickle_and_remove_file(f):
-    data = pickle_load(open(f, 'rb'))
+    data = _unpickle_file(f)
     os.remove(f)
     return data
 
+def _mkstemp(**kwargs):
+    import tempfile
+    fd, f = tempfile.mkstemp(**kwargs)
+    os.close(fd)
+    return f
+
 def _pickle_and_return_filename(data):
-    f = tempfile.mkstemp()[1]
-    pickle_dump(data, open(f, 'wb'))
+    f = _mkstemp()
+    fileobj = open(f, 'wb')
+    if isinstance(data, RecordBatch):
+        _dump_record_batch(data, fileobj)
+    else:
+        pickle_dump(data, fileobj)
+    fileobj.close()
     return f
 
+class AsyncCache(object):
+    """
+    On-disk LRU store for the outputs of cached async functions. Each entry
+    is a pickled value in its own file; when the total size goes over
+    `max_size` bytes, the least recently used entries are removed.
+    """
+    def __init__(self, path, max_size=100*1024*1024):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._evict()
+    
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+    
+    def get(self, key):
+        f = self._entry_path(key)
+        try:
+            data = open(f, 'rb').read()
+        except IOError:
+            return None
+        os.utime(f, None)
+        return data
+    
+    def set(self, key, data):
+        f = self._entry_path(key)
+        try:
+            self.size -= os.stat(f).st_size
+        except OSError:
+            pass
+        tmp = _mkstemp(dir=self.path, prefix='.')
+        open(tmp, 'wb').write(data)
+        os.rename(tmp, f)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self._evict()
+    
+    def _evict(self):
+        """
+        scan the cache directory, recompute `size` and remove the least
+        recently used entries; when over the limit, go down to 90% of it,
+        so that the scan does not run again on the next miss
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            f = self._entry_path(name)
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, f, st.st_size))
+            total += st.st_size
+        if total > self.max_size:
+            entries.sort()
+            while entries and total > self.max_size * .9:
+                mtime, f, size = entries.pop(0)
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+                total -= size
+        self.size = total
+
+def _code_fingerprint(code):
+    """
+    bytecode and constants of a function, so that editing the function
+    invalidates its cached results
+    """
+    consts = tuple( _code_fingerprint(c) if hasattr(c, 'co_code') else c
+                    for c in code.co_consts )
+    return (code.co_code, consts, code.co_names)
+
+def _cache_key_base(func, args, kwargs, input_names, tempfile_output):
+    """
+    pickled description of everything besides the async inputs that the
+    output of a cached function depends on: its code, default argument
+    values, closure variables and call arguments
+    """
+    code = func.func_code
+    parts = [('code', (func.__module__, func.__name__, _code_fingerprint(code), tempfile_output))]
+    parts.append(('default arguments', func.func_defaults))
+    for name, cell in zip(code.co_freevars, func.func_closure or ()):
+        parts.append(('closure variable "%s"' % name, cell.cell_contents))
+    for n, arg in enumerate(args):
+        parts.append(('positional argument %d' % n, arg))
+    for name, arg in sorted(kwargs.iteritems()):
+        if name not in input_names:
+            parts.append(('argument "%s"' % name, arg))
+    
+    pickled = []
+    for description, value in parts:
+        try:
+            pickled.append(pickle_dumps(value, 2))
+        except Exception, e:
+            raise TypeError('async(): cache= needs picklable arguments, defaults and closure '
+                            'variables to build the cache key; %s of %s is not picklable (%s)'
+                            % (description, func.__name__, e))
+    return ''.join(pickled)
+
 def _async_process(func, args, kwargs, input_names):
+    pprocess = _load_pprocess()
     channel = pprocess.create()
     if channel.pid != 0:
         return channel
@@ -51,6 +351,10 @@ def _async_process(func, args, kwargs, input_names):
     for i in input_names:
         kwargs[i].set_channel(channel)
     
+    if _introspection_signal is not None:
+        import signal
+        signal.signal(_introspection_signal, signal.SIG_IGN)
+    
     try:
         try:
             gen = func(*args, **kwargs).__iter__()
@@ -59,7 +363,7 @@ def _async_process(func, args, kwargs, input_names):
             def get_next_value(tempfile_output=False):
                 try:
                     v = gen.next()
-                    if tempfile_output:
+                    if tempfile_output or isinstance(v, RecordBatch):
                         return ('next_value_tempfile', _pickle_and_return_filename(v))
                     else:
                         return ('next_value', v)
@@ -100,33 +404,64 @@ class AsyncInput(object):
             return v
         elif t == 'next_input_tempfile':
             return _unpickle_and_remove_file(v)
+        elif t == 'next_input_record':
+            f, key = v
+            return _load_record_key_and_remove_file(f, key)
         elif t == 'exception':
             raise v
         else:
             raise NotImplemented
 
-class WorkerQueue(pprocess.Exchange):
+class WorkerQueue(object):
     def __init__(self, *args, **kwargs):
-        pprocess.Exchange.__init__(self, *args, **kwargs)
+        self.exchange = _load_pprocess().Exchange(*args, **kwargs)
+        self.exchange.store_data = self.store_data
         self.queue = []
         self.jobs = []
     
+    def add(self, channel):
+        self.exchange.add(channel)
+    
+    def remove(self, channel):
+        self.exchange.remove(channel)
+    
+    def active(self):
+        return self.exchange.active()
+    
+    def store(self, timeout=None):
+        import select, errno
+        while True:
+            try:
+                self.exchange.store(timeout)
+                return
+            except select.error, e:
+                # interrupted by a signal, e.g. dump_pipeline_on_signal
+                if e.args[0] != errno.EINTR:
+                    raise
+    
     def store_data(self, channel):
         channel.worker.store_data()
     
     def tick(self):
-        for job in self.jobs:
-            job.do_pre_poll()
-        if self.active():
+        served = False
+        for job in list(self.jobs):
+            if job.do_pre_poll():
+                served = True
+        if self.active() and not served:
             self.store()
     
     def register(self, job):
         self.jobs.append(job)
+    
+    def unregister(self, job):
+        self.jobs.remove(job)
 
 class Worker(object):
     def __init__(self, channel, job):
         self.channel = channel
         self.job = job
+        self.pending_input = {}
+        self.cache_key = None
         channel.worker = self
     
     def send(self, msg):
@@ -135,7 +470,14 @@ class Worker(object):
     def store_data(self):
         self.job.worker_has_message(self, self.channel.receive())
 
-_async_job_global_queue = WorkerQueue()
+_async_job_global_queue = None
+
+def _get_global_queue():
+    global _async_job_global_queue
+    if _async_job_global_queue is None:
+        _async_job_global_queue = WorkerQueue()
+    return _async_job_global_queue
+
 class AsyncJob(object):
     def __init__(self, func, args, kwargs, input_names, options):
         self.idle_workers = []
@@ -145,11 +487,17 @@ class AsyncJob(object):
         self.buffer_size = options['buffer_size']
         self.tempfile_input = options['tempfile_input']
         self.tempfile_output = options['tempfile_output']
-        self.worker_queue = _async_job_global_queue
+        self.cache = options['cache']
+        self.input_names = input_names
+        self.name = func.__name__
+        self.values_out = 0
+        self.time_base = os.times()[4]
+        self.worker_queue = _get_global_queue()
         self.worker_queue.register(self)
         self.input = {}
         self.waiting_data = 0
         self.stop_iteration = False
+        self.blocked_on_input = None
         
         for name in input_names:
             try:
@@ -162,6 +510,9 @@ class AsyncJob(object):
             kwargs[name] = AsyncInput(name)
             self.input[name] = gen.__iter__()
         
+        if self.cache is not None:
+            self.cache_base = _cache_key_base(func, args, kwargs, input_names, self.tempfile_output)
+        
         for c in range(options['workers']):
             channel = self.launch_worker(func, args, kwargs, input_names)
             w = Worker(channel, self)
@@ -186,46 +537,198 @@ class AsyncJob(object):
     
     def do_pre_poll(self):
         """
-        make sure no workers are blocking on us, to avoid deadlocks
+        make sure no workers are blocking on us, to avoid deadlocks;
+        returns True if some data was served from the cache, in which case
+        there may be nothing for the worker queue to wait on
         """
         
+        served = False
         while self.idle_workers and \
                 (len(self.ready_data) + len(self.busy_workers)) \
                 < (self.buffer_size + self.waiting_data):
             worker = self.idle_workers.pop()
             self.busy_workers.append(worker)
+            if self.cache is not None and self._serve_from_cache(worker):
+                served = True
+                continue
             if self.tempfile_output:
                 worker.send('pull_output_tempfile')
             else:
                 worker.send('pull_output')
             if _log: _log.add('worker_job_start %s' % str(worker))
         
-        if not (self.idle_workers or self.busy_workers or self.ready_data):
-            self.stop_iteration = True
+        if not (self.idle_workers or self.busy_workers or self.ready_data) \
+                and not self.stop_iteration:
+            # all workers have quit
+            self._finish()
         
         while self.workers_waiting_input:
             worker, name = self.workers_waiting_input.pop()
+            self.blocked_on_input = name
             try:
-                input_source = self.input[name]
-                if self.tempfile_input:
-                    if isinstance(input_source, AsyncJob) and input_source.tempfile_output:
-                        v = input_source.next(want_tempfile=True)
-                    else:
-                        v = _pickle_and_return_filename(input_source.next())
-                    worker.send(('next_input_tempfile', v))
+                if self.cache is not None:
+                    self._send_input_value(worker, self._pending_input(worker, name))
                 else:
-                    worker.send(('next_input', input_source.next()))
+                    input_source = self.input[name]
+                    if self.tempfile_input and isinstance(input_source, SplitterOutput) \
+                            and input_source.splitter.shared:
+                        worker.send(('next_input_record', input_source.next(want_record=True)))
+                    elif self.tempfile_input:
+                        if isinstance(input_source, AsyncJob) and input_source.tempfile_output:
+                            v = input_source.next(want_tempfile=True)
+                        else:
+                            v = _pickle_and_return_filename(input_source.next())
+                        worker.send(('next_input_tempfile', v))
+                    else:
+                        self._send_input_value(worker, input_source.next())
                 if _log: _log.add('worker_input_receive %s' % str(worker))
             except Exception, e:
                 worker.send(('exception', e))
                 if _log: _log.add('worker_input_exception %s' % str(worker))
+            finally:
+                self.blocked_on_input = None
+        
+        return served
+    
+    def _send_input_value(self, worker, v):
+        # record batches always travel as raw buffers in a tempfile; the
+        # channel would pickle their columns as escaped text
+        if self.tempfile_input or isinstance(v, RecordBatch):
+            worker.send(('next_input_tempfile', _pickle_and_return_filename(v)))
+        else:
+            worker.send(('next_input', v))
+    
+    def _serve_from_cache(self, worker):
+        """
+        pull one value from each input and look them up in the cache; on a
+        hit, the worker is not involved at all, otherwise the values are
+        kept aside until the worker asks for them
+        """
+        if [t for t, v in worker.pending_input.itervalues() if t == 'value']:
+            # the worker yielded without reading its input; the value it
+            # left behind would be lost
+            self.busy_workers.remove(worker)
+            worker.send('quit')
+            self.worker_queue.remove(worker.channel)
+            self.ready_data.insert(0, ('exception', RuntimeError(
+                'Cached async functions must read exactly one value from each input for every value they yield')))
+            if _log: _log.add('worker_exception %s' % str(worker))
+            return True
+        
+        values = []
+        worker.pending_input = {}
+        worker.cache_key = None
+        for name in self.input_names:
+            self.blocked_on_input = name
+            try:
+                v = self.input[name].next()
+            except Exception, e:
+                worker.pending_input[name] = ('exception', e)
+                values = None
+            else:
+                worker.pending_input[name] = ('value', v)
+                if values is not None:
+                    values.append(v)
+            finally:
+                self.blocked_on_input = None
+        
+        if values is None:
+            # some input is exhausted or broken; let the worker find out
+            return False
+        
+        import hashlib
+        key = hashlib.sha1(self.cache_base + pickle_dumps(tuple(values), 2)).hexdigest()
+        data = self.cache.get(key)
+        if data is None:
+            worker.cache_key = key
+            if _log:
+                _log.cache_misses += 1
+                _log.add('cache_miss %s' % str(worker))
+            return False
+        
+        worker.pending_input = {}
+        self.busy_workers.remove(worker)
+        self.idle_workers.append(worker)
+        if self.tempfile_output:
+            f = _mkstemp()
+            open(f, 'wb').write(data)
+            self.ready_data.insert(0, ('next_value_tempfile', f))
+        else:
+            self.ready_data.insert(0, ('next_value', pickle_loads(data)))
+        if _log:
+            _log.cache_hits += 1
+            _log.add('cache_hit %s' % str(worker))
+        return True
+    
+    def _pending_input(self, worker, name):
+        try:
+            t, v = worker.pending_input.pop(name)
+        except KeyError:
+            raise RuntimeError('Cached async functions must read exactly one value from each input for every value they yield')
+        if t == 'exception':
+            raise v
+        return v
+    
+    def _store_in_cache(self, worker, t, v):
+        key = worker.cache_key
+        worker.cache_key = None
+        if key is None or worker.pending_input:
+            # only store values computed from all the inputs behind the key
+            return
+        if t == 'next_value_tempfile':
+            data = open(v, 'rb').read()
+        else:
+            data = pickle_dumps(v, 2)
+        self.cache.set(key, data)
+    
+    def _finish(self):
+        """
+        the job is done, or has failed: stop idle workers, let go of the
+        inputs and leave the worker queue; workers that are still busy are
+        wound down by _retire_worker as they report back
+        """
+        self.stop_iteration = True
+        self.input = {}
+        self.workers_waiting_input = []
+        while self.idle_workers:
+            worker = self.idle_workers.pop()
+            worker.send('quit')
+            self.worker_queue.remove(worker.channel)
+            if _log: _log.add('worker_quit %s' % str(worker))
+        if self in self.worker_queue.jobs:
+            self.worker_queue.unregister(self)
+    
+    def _retire_worker(self, worker, message):
+        t, v = message
+        if t == 'pull_input':
+            # ends the worker's generator; it will report stop_iteration
+            worker.send(('exception', StopIteration()))
+        elif t in ('next_value', 'next_value_tempfile'):
+            if t == 'next_value_tempfile':
+                os.remove(v)
+            worker.send('quit')
+            self.busy_workers.remove(worker)
+            self.worker_queue.remove(worker.channel)
+            if _log: _log.add('worker_quit %s' % str(worker))
+        elif t == 'exception':
+            # the worker process exits by itself
+            self.busy_workers.remove(worker)
     
     def worker_has_message(self, worker, message):
         t, v = message
+        if self.stop_iteration and t != 'stop_iteration':
+            self._retire_worker(worker, message)
+            return
+        
         if t == 'pull_input':
             self.workers_waiting_input.insert(0, (worker, v))
             if _log: _log.add('worker_input_request %s' % str(worker))
         elif t in ('next_value', 'next_value_tempfile'):
+            if t == 'next_value_tempfile' and not self.tempfile_output:
+                # a record batch, sent through a tempfile by the worker
+                t, v = 'next_value', _unpickle_and_remove_file(v)
+            if self.cache is not None:
+                self._store_in_cache(worker, t, v)
             self.ready_data.insert(0, (t, v))
             self.busy_workers.remove(worker)
             self.idle_workers.insert(0, worker)
@@ -259,6 +762,8 @@ class AsyncJob(object):
             raise StopIteration
         
         t, v = self.ready_data.pop()
+        if t != 'exception':
+            self.values_out += 1
         if t == 'next_value':
             if want_tempfile:
                 raise RuntimeError('tempfile data was requested; worker returned normal data')
@@ -270,7 +775,7 @@ class AsyncJob(object):
             else:
                 return _unpickle_and_remove_file(v)
         elif t == 'exception':
-            self.stop_iteration = True
+            self._finish()
             raise v
         else:
             raise NotImplementedError
@@ -280,6 +785,70 @@ class AsyncJob(object):
         self._wait_for_next()
         return self._get_data(want_tempfile)
 
+class SharedRecord(object):
+    """
+    A record from a shared-mode Splitter, queued once for every key. It is
+    written to a tempfile at most once, with each key's value stored
+    separately behind an offset index; each consumer with tempfile input
+    gets its own hard link to that file, and loads only its own key in the
+    worker process. Each key is still pickled once, as in non-shared mode;
+    the saving is one tempfile per record instead of one per key. Nothing
+    is pickled in the parent when the upstream job has tempfile output,
+    but then the consumers have to load the whole record.
+    """
+    def __init__(self, keys, data=None, filename=None):
+        self.keys = keys
+        self.refcount = len(keys)
+        self.data = data
+        self.filename = filename
+        self.links = 0
+        self.pid = os.getpid()
+    
+    def value(self, key):
+        if self.filename is not None and self.data is None:
+            self.data = _unpickle_file(self.filename)
+        return self.data[key]
+    
+    def link(self):
+        if self.filename is None:
+            if isinstance(self.data, RecordBatch):
+                self.filename = _pickle_and_return_filename(self.data)
+            else:
+                self.filename = _mkstemp()
+                fileobj = open(self.filename, 'wb')
+                _dump_keyed_record(self.data, self.keys, fileobj)
+                fileobj.close()
+        self.links += 1
+        f = '%s.%d' % (self.filename, self.links)
+        try:
+            os.link(self.filename, f)
+        except (OSError, AttributeError):
+            # no hard links on this filesystem or platform
+            import shutil
+            shutil.copyfile(self.filename, f)
+        return f
+    
+    def release(self):
+        self.refcount -= 1
+        if self.refcount == 0:
+            self.data = None
+            self._remove_file()
+    
+    def _remove_file(self, remove=os.remove, getpid=os.getpid):
+        # worker processes have a copy of this object; only the process
+        # that created it owns the file
+        if self.filename is not None and getpid() == self.pid:
+            try:
+                remove(self.filename)
+            except OSError:
+                pass
+        self.filename = None
+    
+    def __del__(self):
+        # some keys were never read to the end, e.g. the splitter was
+        # dropped while records were still queued
+        self._remove_file()
+
 class SplitterOutput(object):
     def __init__(self, splitter, key):
         self.splitter = splitter
@@ -288,14 +857,18 @@ class SplitterOutput(object):
     def __iter__(self):
         return self
     
-    def next(self):
-        return self.splitter._pull(self.key)
+    def next(self, want_record=False):
+        return self.splitter._pull(self.key, want_record)
 
 class Splitter(object):
-    def __init__(self, input_generator, keys):
+    def __init__(self, input_generator, keys, shared=False):
         self.input = input_generator.__iter__()
         self.queues = dict( (key, []) for key in keys )
         self.waiting_for_next = False
+        self.shared = shared
+        self.records_in = 0
+        self.time_base = os.times()[4]
+        _live_splitters.add(self)
     
     def get(self, key):
         if key not in self.queues.keys():
@@ -306,6 +879,7 @@ class Splitter(object):
         return self.get(key)
     
     def _pull_input(self):
+        record = None
         if isinstance(self.input, AsyncJob):
             if not self.waiting_for_next:
                 self.waiting_for_next = True
@@ -315,7 +889,10 @@ class Splitter(object):
             
             if self.waiting_for_next:
                 try:
-                    data = self.input._get_data()
+                    if self.shared and self.input.tempfile_output:
+                        record = SharedRecord(self.queues.keys(), filename=self.input._get_data(want_tempfile=True))
+                    else:
+                        data = self.input._get_data()
                 finally:
                     self.waiting_for_next = False
             else:
@@ -324,16 +901,147 @@ class Splitter(object):
         else:
             data = self.input.next()
         
-        for key, queue in self.queues.iteritems():
-            queue.insert(0, data[key])
+        self.records_in += 1
+        if self.shared:
+            if record is None:
+                record = SharedRecord(self.queues.keys(), data=data)
+            for queue in self.queues.itervalues():
+                queue.insert(0, record)
+        else:
+            for key, queue in self.queues.iteritems():
+                queue.insert(0, data[key])
     
-    def _pull(self, key):
+    def _pull(self, key, want_record=False):
         queue = self.queues[key]
         if not queue:
             self._pull_input()
         if not queue:
             raise StopIteration
-        return queue.pop()
+        if not self.shared:
+            return queue.pop()
+        
+        record = queue.pop()
+        try:
+            if want_record:
+                return (record.link(), key)
+            else:
+                return record.value(key)
+        finally:
+            record.release()
+
+_live_splitters = weakref.WeakSet()
+
+def _stall_reason(job):
+    if job.stop_iteration:
+        return 'finished'
+    if job.blocked_on_input is not None:
+        return 'blocked on input %s' % job.blocked_on_input
+    if job.workers_waiting_input:
+        return 'waiting for input'
+    if job.busy_workers:
+        return 'computing'
+    if job.ready_data:
+        return 'waiting for consumer'
+    return 'idle'
+
+def _splitter_stall_reason(splitter):
+    if splitter.waiting_for_next:
+        return 'waiting on upstream'
+    depth, key = max( (len(q), k) for k, q in splitter.queues.iteritems() )
+    if depth:
+        # the consumer of `key` is the one falling behind
+        return 'queue backlog %s' % key
+    return 'idle'
+
+def _stage_id(source):
+    if isinstance(source, SplitterOutput):
+        return id(source.splitter)
+    return id(source)
+
+def pipeline_snapshot():
+    """
+    Return a list of dicts describing the state of every running AsyncJob
+    and live Splitter in this process: queue depths, worker states,
+    throughput (values per second since the stage was created) and, for
+    a guess at what the stage is waiting for. `id` is the id() of the
+    stage object; `inputs` (for jobs) and `input` (for splitters) hold the
+    ids of the upstream stages, which gives the edges of the graph.
+    """
+    now = os.times()[4]
+    stages = []
+    jobs = _async_job_global_queue.jobs if _async_job_global_queue else []
+    for job in jobs:
+        if job.stop_iteration:
+            continue
+        elapsed = now - job.time_base
+        stages.append({
+            'type': 'job',
+            'id': id(job),
+            'name': job.name,
+            'values_out': job.values_out,
+            'throughput': job.values_out / elapsed if elapsed > 0 else 0.,
+            'ready_data': len(job.ready_data),
+            'waiting_data': job.waiting_data,
+            'idle_workers': len(job.idle_workers),
+            'busy_workers': len(job.busy_workers),
+            'workers_waiting_input': len(job.workers_waiting_input),
+            'stall': _stall_reason(job),
+            'inputs': dict( (name, _stage_id(source)) for name, source in job.input.iteritems() ),
+        })
+    for splitter in list(_live_splitters):
+        elapsed = now - splitter.time_base
+        stages.append({
+            'type': 'splitter',
+            'id': id(splitter),
+            'name': 'splitter(%s)' % ', '.join(str(k) for k in sorted(splitter.queues)),
+            'records_in': splitter.records_in,
+            'throughput': splitter.records_in / elapsed if elapsed > 0 else 0.,
+            'queues': dict( (k, len(q)) for k, q in splitter.queues.iteritems() ),
+            'waiting_for_next': splitter.waiting_for_next,
+            'stall': _splitter_stall_reason(splitter),
+            'input': id(splitter.input),
+        })
+    return stages
+
+def format_pipeline_snapshot(stages):
+    lines = []
+    for stage in stages:
+        if stage['type'] == 'job':
+            inputs = ', '.join('%s=%x' % kv for kv in sorted(stage['inputs'].items()))
+            lines.append(('job %(name)s: %(stall)s, %(values_out)d out (%(throughput).1f/s), '
+                          'ready %(ready_data)d, requested %(waiting_data)d, '
+                          'workers idle %(idle_workers)d busy %(busy_workers)d '
+                          'waiting input %(workers_waiting_input)d, id %(id)x' % stage) +
+                         (', inputs ' + inputs if inputs else ''))
+        else:
+            queues = ', '.join('%s=%d' % kv for kv in sorted(stage['queues'].items()))
+            lines.append('%s: %d in (%.1f/s), %s, queues %s, id %x, input %x' % (
+                stage['name'], stage['records_in'], stage['throughput'], stage['stall'],
+                queues, stage['id'], stage['input']))
+    return '\n'.join(lines)
+
+_introspection_signal = None
+
+def dump_pipeline_on_signal(signum=None, stream=None):
+    """
+    Install a handler that writes a pipeline report to `stream` (stderr by
+    default) whenever this process receives `signum` (SIGUSR1 by default),
+    e.g. with `kill -USR1 <pid>`. Worker processes ignore the signal.
+    """
+    global _introspection_signal
+    import signal
+    if signum is None:
+        signum = signal.SIGUSR1
+    
+    def handler(signum, frame):
+        out = stream or sys.stderr
+        out.write('asyncgen pipeline report, pid %d\n' % os.getpid())
+        out.write(format_pipeline_snapshot(pipeline_snapshot()) + '\n')
+        out.flush()
+    
+    signal.signal(signum, handler)
+    signal.siginterrupt(signum, False)
+    _introspection_signal = signum
 
 def async(*input_names, **kwargs):
     def decorator(func):
@@ -342,9 +1050,16 @@ def async(*input_names, **kwargs):
             'buffer_size': kwargs.pop('buffer', 0),
             'tempfile_input': kwargs.pop('tempfile_input', False),
             'tempfile_output': kwargs.pop('tempfile_output', False),
+            'cache': kwargs.pop('cache', None),
         }
         if kwargs:
             raise TypeError("async() got an unexpected keyword argument '%s'" % kwargs.keys()[0])
+        if options['cache'] is not None and not input_names:
+            raise ValueError('async(): cache= needs at least one async input to key on')
+        if isinstance(options['cache'], basestring):
+            # one store per decorated function, so the directory is only
+            # scanned once
+            options['cache'] = AsyncCache(options['cache'])
         
         def wrapper(*args, **kwargs):
             return AsyncJob(func, args, kwargs, input_names, options)
@@ -357,8 +1072,8 @@ def async(*input_names, **kwargs):
     else:
         return decorator
 
-def generator_splitter(input_generator, keys):
-    return Splitter(input_generator, keys)
+def generator_splitter(input_generator, keys, shared=False):
+    return Splitter(input_generator, keys, shared)
 
 def generator_map(func, *inputs):
     generators = list(i.__iter__() for i in inputs)
@@ -280,6 +280,47 @@ class PickeTestCase(unittest.TestCase):
         
         self.failUnlessEqual(list(f(i=f(i=[1,2,3]))), [3, 4, 5])
         self.failUnlessEqual(''.join(self.pickle_log), 'ioioio')
+    
+    def test_shared_split_files(self):
+        files = []
+        real_mkstemp = asyncgen._mkstemp
+        def _mkstemp(**kwargs):
+            f = real_mkstemp(**kwargs)
+            files.append(f)
+            return f
+        asyncgen._mkstemp = _mkstemp
+        
+        @async('i', tempfile_input=True)
+        def f(i):
+            for val in i:
+                yield val
+        
+        try:
+            for shared in (False, True):
+                del files[:]
+                gs = generator_splitter([(1, 2, 3), (4, 5, 6)], [0, 1, 2], shared=shared)
+                outs = list( f(i=gs[n]) for n in range(3) )
+                self.failUnlessEqual(list(list(o) for o in outs), [[1, 4], [2, 5], [3, 6]])
+                # one tempfile per record instead of one per key
+                self.failUnlessEqual(len(files), 2 if shared else 6)
+        finally:
+            asyncgen._mkstemp = real_mkstemp
+    
+    def test_pickle_shared_split_chain(self):
+        @async(tempfile_output=True)
+        def src():
+            yield {'a': 1, 'b': 2}
+            yield {'a': 3, 'b': 4}
+        
+        @async('i', tempfile_input=True)
+        def f(i):
+            for val in i:
+                yield val
+        
+        gs = generator_splitter(src(), ['a', 'b'], shared=True)
+        fa, fb = f(i=gs['a']), f(i=gs['b'])
+        self.failUnlessEqual((list(fa), list(fb)), ([1, 3], [2, 4]))
+        self.failUnlessEqual(''.join(self.pickle_log), '')
 
 class GeneratorSplitterTestCase(unittest.TestCase):
     def test_split(self):
@@ -301,6 +342,69 @@ class GeneratorSplitterTestCase(unittest.TestCase):
     def test_dict(self):
         self.failUnlessEqual(list(generator_splitter([{'a':2}], ['a'])['a']), [2])
     
+    def test_shared(self):
+        gs = generator_splitter([(1, 'a'), (2, 'b')], [0, 1], shared=True)
+        self.failUnlessEqual(list(gs[0]), [1, 2])
+        self.failUnlessEqual(list(gs[1]), ['a', 'b'])
+    
+    def test_shared_cleanup(self):
+        import os, shutil, tempfile
+        tmp = tempfile.mkdtemp()
+        old_tempdir = tempfile.tempdir
+        tempfile.tempdir = tmp
+        try:
+            @async(tempfile_output=True)
+            def src():
+                for n in range(3):
+                    yield {'a': n, 'b': -n, 'c': n*n}
+            
+            gs = generator_splitter(src(), ['a', 'b', 'c'], shared=True)
+            self.failUnlessEqual(list(gs['a']), [0, 1, 2])
+            self.failUnlessEqual(len(os.listdir(tmp)), 3)
+            del gs
+            self.failUnlessEqual(os.listdir(tmp), [])
+        finally:
+            tempfile.tempdir = old_tempdir
+            shutil.rmtree(tmp)
+    
+    def test_shared_missing_column_cleanup(self):
+        import os, shutil, tempfile
+        tmp = tempfile.mkdtemp()
+        old_tempdir = tempfile.tempdir
+        tempfile.tempdir = tmp
+        try:
+            @async('i', tempfile_input=True)
+            def dst(i):
+                for v in i:
+                    yield v
+            
+            batch = asyncgen.RecordBatch.from_records([('a', 'i')], [(1,)])
+            gs = generator_splitter([batch], ['a', 'missing'], shared=True)
+            job = dst(i=gs['missing'])
+            self.failUnlessRaises(KeyError, job.next)
+            del gs, job
+            self.failUnlessEqual(os.listdir(tmp), [])
+        finally:
+            tempfile.tempdir = old_tempdir
+            shutil.rmtree(tmp)
+    
+    def test_shared_without_hard_links(self):
+        import os
+        real_link = os.link
+        def link(src, dst):
+            raise OSError('no hard links here')
+        os.link = link
+        try:
+            @async('i', tempfile_input=True)
+            def dst(i):
+                for v in i:
+                    yield v
+            
+            gs = generator_splitter([{'a': 1, 'b': 2}], ['a', 'b'], shared=True)
+            self.failUnlessEqual((list(dst(i=gs['a'])), list(dst(i=gs['b']))), ([1], [2]))
+        finally:
+            os.link = real_link
+    
     def test_bad_input(self):
         self.failUnlessRaises(TypeError, lambda: generator_splitter([13], [0])[0].next())
     
@@ -357,6 +461,71 @@ class GeneratorSplitterTestCase(unittest.TestCase):
         for n in range(3):
             self.failUnlessEqual(list(outs[n]), [n])
 
+class RecordBatchTestCase(unittest.TestCase):
+    schema = [('id', 'i'), ('score', 'd')]
+    
+    def make_batch(self):
+        return asyncgen.RecordBatch.from_records(self.schema,
+            [(1, .5), {'id': 2, 'score': 1.5}, (3, 2.5)])
+    
+    def test_columns_and_rows(self):
+        batch = self.make_batch()
+        self.failUnlessEqual(len(batch), 3)
+        self.failUnlessEqual(list(batch['id']), [1, 2, 3])
+        self.failUnlessEqual(batch.row(1), (2, 1.5))
+        self.failUnlessEqual(list(batch), [(1, .5), (2, 1.5), (3, 2.5)])
+        self.failUnlessEqual(batch.records()[2], {'id': 3, 'score': 2.5})
+        self.failUnlessRaises(KeyError, lambda: batch['name'])
+        self.failUnlessRaises(ValueError, lambda: batch.append((4,)))
+        self.failUnlessRaises(TypeError, lambda: batch.append((4, 'x')))
+        self.failUnlessEqual(len(batch['id']), 3)
+        self.failUnlessEqual(len(list(batch)), 3)
+    
+    def test_pickle(self):
+        batch = self.make_batch()
+        self.failUnlessEqual(cPickle.loads(cPickle.dumps(batch, 2)), batch)
+        self.failUnlessEqual(cPickle.loads(cPickle.dumps(batch)), batch)
+    
+    def test_async_transport(self):
+        @async('i', tempfile_input=True, tempfile_output=True)
+        def f(i):
+            for batch in i:
+                batch.append((len(batch) + 1, 0.))
+                yield batch
+        
+        @async('i')
+        def g(i):
+            for batch in i:
+                yield batch
+        
+        out = list(g(i=f(i=[self.make_batch()])))
+        self.failUnlessEqual(len(out), 1)
+        self.failUnlessEqual(list(out[0]['id']), [1, 2, 3, 4])
+    
+    def test_channel_transport(self):
+        @async('i')
+        def f(i):
+            for batch in i:
+                batch.append((4, 3.5))
+                yield batch
+        
+        out = list(f(i=[self.make_batch()]))
+        self.failUnlessEqual(list(out[0]['score']), [.5, 1.5, 2.5, 3.5])
+    
+    def test_split_columns(self):
+        @async('i', tempfile_input=True)
+        def total(i):
+            yield sum(sum(column) for column in i)
+        
+        batches = [self.make_batch(), self.make_batch()]
+        gs = generator_splitter(batches, ['id', 'score'], shared=True)
+        ids, scores = total(i=gs['id']), total(i=gs['score'])
+        self.failUnlessEqual((list(ids), list(scores)), ([12], [9.]))
+    
+    def test_generator_map(self):
+        self.failUnlessEqual(list(generator_map(lambda row: row[0] * row[1], self.make_batch())),
+                             [.5, 3., 7.5])
+
 class LoggingTestCase(unittest.TestCase):
     def setUp(self):
         async_log.enable()
@@ -393,5 +562,224 @@ class LoggingTestCase(unittest.TestCase):
         self.failUnlessEqual(len(filter(lambda e: 'worker_input_receive' in e, async_log.events)), 2)
         self.failUnlessEqual(len(filter(lambda e: 'worker_input_exception' in e, async_log.events)), 1)
 
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        async_log.enable()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+        async_log.reset()
+    
+    def test_cache_hits(self):
+        @async('i', cache=self.cache_dir)
+        def f(i):
+            for v in i:
+                yield v*v
+        
+        self.failUnlessEqual(list(f(i=[1, 2, 1])), [1, 4, 1])
+        self.failUnlessEqual(async_log.cache_hits, 1)
+        self.failUnlessEqual(async_log.cache_misses, 2)
+        
+        self.failUnlessEqual(list(f(i=[2, 3])), [4, 9])
+        self.failUnlessEqual(async_log.cache_hits, 2)
+        self.failUnlessEqual(async_log.cache_misses, 3)
+    
+    def test_cache_multiple_inputs(self):
+        @async('i', 'j', cache=self.cache_dir, tempfile_output=True)
+        def f(i, j, sep):
+            while True:
+                yield '%s%s%s' % (i.next(), sep, j.next())
+        
+        self.failUnlessEqual(list(f(i=[1, 2], j=['a', 'b'], sep='-')), ['1-a', '2-b'])
+        self.failUnlessEqual(list(f(i=[1, 2], j=['b', 'a'], sep='-')), ['1-b', '2-a'])
+        self.failUnlessEqual(list(f(i=[2], j=['b'], sep='-')), ['2-b'])
+        self.failUnlessEqual(list(f(i=[2], j=['b'], sep='+')), ['2+b'])
+        self.failUnlessEqual(async_log.cache_hits, 1)
+        self.failUnlessEqual(async_log.cache_misses, 5)
+    
+    def test_cache_reading_too_much(self):
+        @async('i', cache=self.cache_dir)
+        def f(i):
+            while True:
+                yield i.next() + i.next()
+        
+        self.failUnlessRaises(RuntimeError, lambda: list(f(i=[1, 2])))
+    
+    def test_cache_reading_too_little(self):
+        @async('i', cache=self.cache_dir)
+        def f(i):
+            for v in i:
+                yield v
+                yield -v
+        
+        self.failUnlessRaises(RuntimeError, lambda: list(f(i=[1, 2, 3])))
+        self.failUnlessRaises(RuntimeError, lambda: list(f(i=[1, 2, 3])))
+        self.failUnlessEqual(async_log.cache_hits, 1)
+    
+    def test_cache_function_changed(self):
+        def make(factor):
+            if factor == 2:
+                def f(i):
+                    for v in i:
+                        yield v * 2
+            else:
+                def f(i):
+                    for v in i:
+                        yield v * 10
+            return async('i', cache=self.cache_dir)(f)
+        
+        self.failUnlessEqual(list(make(2)(i=[1, 2])), [2, 4])
+        self.failUnlessEqual(list(make(10)(i=[1, 2])), [10, 20])
+        self.failUnlessEqual(list(make(2)(i=[1, 2])), [2, 4])
+        self.failUnlessEqual(async_log.cache_hits, 2)
+    
+    def test_cache_closure_and_defaults(self):
+        def make(factor):
+            @async('i', cache=self.cache_dir)
+            def f(i):
+                for v in i:
+                    yield v * factor
+            return f
+        
+        def make_with_default(factor):
+            @async('i', cache=self.cache_dir)
+            def f(i, factor=factor):
+                for v in i:
+                    yield v * factor
+            return f
+        
+        self.failUnlessEqual(list(make(2)(i=[1, 2])), [2, 4])
+        self.failUnlessEqual(list(make(10)(i=[1, 2])), [10, 20])
+        self.failUnlessEqual(list(make_with_default(2)(i=[1, 2])), [2, 4])
+        self.failUnlessEqual(list(make_with_default(10)(i=[1, 2])), [10, 20])
+        self.failUnlessEqual(list(make(10)(i=[1, 2])), [10, 20])
+        self.failUnlessEqual(async_log.cache_hits, 2)
+    
+    def test_cache_unpicklable_argument(self):
+        @async('i', cache=self.cache_dir)
+        def f(i, func):
+            for v in i:
+                yield func(v)
+        
+        try:
+            f(i=[1], func=lambda v: v)
+            self.fail('did not raise TypeError')
+        except TypeError, e:
+            self.failUnless('argument "func" of f is not picklable' in str(e))
+    
+    def test_cache_without_input(self):
+        self.failUnlessRaises(ValueError, lambda: async(cache=self.cache_dir)(lambda: None))
+    
+    def test_cache_eviction(self):
+        import os
+        cache = asyncgen.AsyncCache(self.cache_dir, max_size=10)
+        cache.set('a', 'x' * 6)
+        os.utime(os.path.join(self.cache_dir, 'a'), (0, 0))
+        cache.set('b', 'y' * 6)
+        self.failUnlessEqual(cache.get('a'), None)
+        self.failUnlessEqual(cache.get('b'), 'y' * 6)
+
+class IntrospectionTestCase(unittest.TestCase):
+    def test_snapshot(self):
+        @async('i')
+        def introspected(i):
+            for v in i:
+                yield v
+        
+        gs = generator_splitter([(1, 2), (3, 4)], [0, 1])
+        job = introspected(i=gs[0])
+        self.failUnlessEqual(job.next(), 1)
+        
+        stages = asyncgen.pipeline_snapshot()
+        job_stage, = [s for s in stages if s['id'] == id(job)]
+        self.failUnlessEqual(job_stage['name'], 'introspected')
+        self.failUnlessEqual(job_stage['values_out'], 1)
+        self.failUnlessEqual(job_stage['stall'], 'idle')
+        self.failUnlessEqual(job_stage['inputs'], {'i': id(gs)})
+        split_stage, = [s for s in stages if s['id'] == id(gs)]
+        self.failUnlessEqual(split_stage['name'], 'splitter(0, 1)')
+        self.failUnlessEqual(split_stage['records_in'], 1)
+        self.failUnlessEqual(split_stage['queues'], {0: 0, 1: 1})
+        self.failUnlessEqual(split_stage['stall'], 'queue backlog 1')
+        self.failUnlessEqual(split_stage['input'], id(gs.input))
+        
+        report = asyncgen.format_pipeline_snapshot(stages)
+        self.failUnless('job introspected: idle, 1 out' in report)
+        self.failUnless('splitter(0, 1): 1 in' in report)
+        
+        self.failUnless(', inputs i=%x' % id(gs) in report)
+        
+        self.failUnlessEqual(list(job), [3])
+        stages = asyncgen.pipeline_snapshot()
+        self.failUnlessEqual([s for s in stages if s['id'] == id(job)], [])
+        split_stage, = [s for s in stages if s['id'] == id(gs)]
+        self.failUnlessEqual(split_stage['records_in'], 2)
+    
+    def test_failed_jobs_unregister(self):
+        @async('i', workers=2)
+        def failing(i):
+            for v in i:
+                raise ValueError('failed on %d' % v)
+            yield
+        
+        jobs = [failing(i=[n]) for n in range(3)]
+        for job in jobs:
+            self.failUnlessRaises(ValueError, job.next)
+        queue_jobs = asyncgen._async_job_global_queue.jobs
+        self.failUnlessEqual([job for job in jobs if job in queue_jobs], [])
+        self.failUnlessEqual([s for s in asyncgen.pipeline_snapshot() if s['name'] == 'failing'], [])
+    
+    def test_dump_on_signal(self):
+        import os, signal, time, StringIO
+        out = StringIO.StringIO()
+        previous = signal.getsignal(signal.SIGUSR1)
+        asyncgen.dump_pipeline_on_signal(stream=out)
+        try:
+            @async
+            def slow():
+                os.kill(os.getppid(), signal.SIGUSR1)
+                time.sleep(.05)
+                yield 1
+            
+            @async('i')
+            def consumer(i):
+                for v in i:
+                    yield v
+            
+            self.failUnlessEqual(list(consumer(i=slow())), [1])
+            self.failUnless('job slow: computing' in out.getvalue())
+            self.failUnless('job consumer: blocked on input i' in out.getvalue())
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+            asyncgen._introspection_signal = None
+
+class ImportTimeTestCase(unittest.TestCase):
+    """
+    Importing asyncgen should not pull in the process backend or create
+    the worker queue; those happen on first use of @async
+    """
+    budget = 0.05 # seconds
+    
+    def run_in_fresh_interpreter(self, code):
+        import os, sys, subprocess
+        p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return p.communicate()[0]
+    
+    def test_lazy_modules(self):
+        out = self.run_in_fresh_interpreter(
+            'import sys; import asyncgen; '
+            'print [m for m in ("pprocess", "tempfile", "hashlib") if m in sys.modules], '
+            'asyncgen._async_job_global_queue')
+        self.failUnlessEqual(out.strip(), '[] None')
+    
+    def test_import_time(self):
+        out = self.run_in_fresh_interpreter(
+            'import time; t = time.time(); import asyncgen; print time.time() - t')
+        self.failUnless(float(out) < self.budget, 'import took %ss' % out.strip())
+
 if __name__ == '__main__':
     unittest.main()